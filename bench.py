@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for newscast.
+
+Usage: bench.py [startup] [memory] [-n RUNS] [--articles N] [--news-dir DIR]
+"""
+
+import os
+import sys
+import json
+import argparse
+import tracemalloc
+import tempfile
+import statistics
+import subprocess
+from time import perf_counter
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+NEWSCAST = os.path.join(HERE, "newscast.py")
+
+HEAVY_MODULES = ("mwclient", "requests", "bs4", "lxml", "dateutil", "config")
+
+def time_command(cmd, runs, cwd):
+	env = dict(os.environ, PYTHONPATH=HERE)
+	times = []
+	for _ in range(runs):
+		start = perf_counter()
+		subprocess.run(cmd, cwd=cwd, env=env, check=True,
+			stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+		times.append((perf_counter() - start) * 1000)
+	#endfor
+	return times
+#enddef
+
+def report(label, times, baseline=None):
+	median = statistics.median(times)
+	line = f"{label:<28} median {median:7.1f} ms  min {min(times):7.1f} ms"
+	if baseline is not None:
+		line += f"  (+{median - baseline:.1f} ms over bare interpreter)"
+	#endif
+	print(line)
+	return median
+#enddef
+
+def bench_startup(args):
+	runs = args.runs
+	with tempfile.TemporaryDirectory() as cwd:
+		# Import must not touch the filesystem or pull in heavy modules.
+		check = (
+			"import sys, newscast; "
+			f"print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+		)
+		loaded = subprocess.run([sys.executable, "-c", check], cwd=cwd,
+			env=dict(os.environ, PYTHONPATH=HERE), check=True,
+			capture_output=True, text=True).stdout.strip()
+		print(f"Heavy modules loaded on import: {loaded or 'none'}")
+		print(f"Files created on import: {', '.join(os.listdir(cwd)) or 'none'}")
+
+		baseline = report("bare interpreter", time_command(
+			[sys.executable, "-c", "pass"], runs, cwd))
+		report("import newscast", time_command(
+			[sys.executable, "-c", "import newscast"], runs, cwd), baseline)
+		# No known entries, so there's no maintenance to post.
+		report("maint --dry-run, no work", time_command(
+			[sys.executable, NEWSCAST, "--dry-run", "maint"], runs, cwd), baseline)
+	#endwith
+#enddef
+
+class FakeResponse:
+	""" Serves a canned body the way requests would, for the news list. """
+	def __init__(self, body):
+		self.body = body
+		self.encoding = "utf-8"
+	#enddef
+
+	def json(self):
+		return json.loads(self.body)
+	#enddef
+
+	def raise_for_status(self):
+		pass
+	#enddef
+
+	def iter_content(self, chunk_size):
+		for i in range(0, len(self.body), chunk_size):
+			yield self.body[i:i + chunk_size]
+		#endfor
+	#enddef
+
+	def __enter__(self):
+		return self
+	#enddef
+
+	def __exit__(self, *exc):
+		pass
+	#enddef
+#endclass
+
+def peak_memory(fn):
+	tracemalloc.start()
+	try:
+		fn()
+		return tracemalloc.get_traced_memory()[1]
+	finally:
+		tracemalloc.stop()
+	#endtry
+#enddef
+
+def report_memory(label, peak):
+	print(f"{label:<36} peak {peak / 2**20:8.2f} MiB")
+#enddef
+
+def bench_memory(args):
+	sys.path.insert(0, HERE)
+	import newscast
+
+	# Roughly the shape of the real news list.
+	body = json.dumps([
+		{
+			"Id": 100000 + i,
+			"Title": f"Some Event Returns {i}!",
+			"Summary": "Lorem ipsum dolor sit amet. " * 20,
+			"ImageThumbnail": f"https://example.com/{i}.png",
+			"LiveDate": "2024-01-01T00:00:00Z",
+			"Category": "events",
+		}
+		for i in range(args.articles)
+	]).encode("utf-8")
+	newscast.get = lambda url, **kwargs: FakeResponse(body)
+	print(f"News list of {args.articles} articles, {len(body) / 2**20:.1f} MiB")
+
+	# Start with nothing known.
+	nn = newscast.NexonNews(known_file=os.devnull, archive_ids_file=os.devnull)
+	report_memory("fetch_news_list", peak_memory(
+		lambda: [idx for idx, *_ in nn.fetch_news_list() if not nn.is_known(idx)]))
+	report_memory("iter_news_list (--stream)", peak_memory(
+		lambda: [idx for idx, *_ in nn.iter_news_list() if not nn.is_known(idx)]))
+
+	# Parse cached articles, if we have any. Sales are skipped since
+	# they look up shop items over the network.
+	try:
+		import bs4, lxml
+	except ImportError:
+		print("bs4/lxml not installed, skipping article parsing")
+		return
+	#endtry
+
+	articles = []
+	if os.path.isdir(args.news_dir):
+		for fn in sorted(os.listdir(args.news_dir)):
+			if fn.endswith(".json"):
+				with open(os.path.join(args.news_dir, fn), encoding="utf8") as f:
+					article = json.load(f)
+				#endwith
+				if article.get("Category") != "sales":
+					articles.append((fn[:-5], article))
+				#endif
+			#endif
+		#endfor
+	#endif
+	if not articles:
+		print(f"No cached articles in {args.news_dir}, skipping article parsing")
+		return
+	#endif
+
+	def parse_all():
+		for idx, article in articles:
+			nn.parse_article(idx, article)
+		#endfor
+	#enddef
+	report_memory(f"parse_article x {len(articles)}", peak_memory(parse_all))
+#enddef
+
+BENCHMARKS = {
+	"startup": bench_startup,
+	"memory": bench_memory,
+}
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark newscast.")
+	parser.add_argument("benchmarks", nargs="*", metavar="benchmark",
+		help="benchmarks to run: " + ", ".join(BENCHMARKS) + " (default: all)")
+	parser.add_argument("-n", "--runs", type=int, default=10,
+		help="number of runs to time (default: 10)")
+	parser.add_argument("--articles", type=int, default=20000,
+		help="size of the news list for the memory benchmark (default: 20000)")
+	parser.add_argument("--news-dir", default="news",
+		help="cached articles to parse for the memory benchmark (default: news)")
+	args = parser.parse_args()
+
+	for name in args.benchmarks or BENCHMARKS:
+		if name not in BENCHMARKS:
+			parser.error(f"unknown benchmark: {name}")
+		#endif
+		print(f"== {name} ==")
+		BENCHMARKS[name](args)
+	#endfor
+#enddef
+
+if __name__ == '__main__':
+	main()
+#endif
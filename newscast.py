@@ -5,48 +5,79 @@ import re
 import csv
 import json
 import logging
+import argparse
+import codecs
+import tempfile
+import threading
+from contextlib import contextmanager
 from math import ceil
-from datetime import date, datetime, timedelta
+from time import monotonic, sleep
+from urllib.parse import urlsplit
+from datetime import date, datetime, timedelta, timezone
+from functools import lru_cache, partial
 from itertools import chain
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-import mwclient
-import requests
-import dateutil.tz
-import dateutil.parser
-from bs4 import BeautifulSoup, element as bs4_element
-
-import config
+# The wiki client, HTTP client, HTML parser, dateutil, and config are
+# imported by the functions that need them, so stages which don't touch
+# them (and importing this module) stay cheap.
 
 logger = logging.getLogger("newscast")
-logger.setLevel(logging.INFO)
-logstream = logging.StreamHandler()
-logstream.setLevel(logging.INFO)
-logger.addHandler(logstream)
-
-os.makedirs("news", exist_ok=True)
-os.makedirs("shop", exist_ok=True)
-
-tz_pacific = dateutil.tz.gettz("America/Los_Angeles")
-tzinfos = {
-	"PDT": tz_pacific,
-	"PST": tz_pacific
-}
+
+def setup_logging():
+	if logger.handlers:
+		return
+	#endif
+
+	logger.setLevel(logging.INFO)
+	logstream = logging.StreamHandler()
+	logstream.setLevel(logging.INFO)
+	logger.addHandler(logstream)
+#enddef
+
+@lru_cache(maxsize=None)
+def tz_pacific():
+	import dateutil.tz
+	return dateutil.tz.gettz("America/Los_Angeles")
+#enddef
+
+@lru_cache(maxsize=None)
+def tzinfos():
+	return {
+		"PDT": tz_pacific(),
+		"PST": tz_pacific()
+	}
+#enddef
+
+def parse_iso(date):
+	# Dates we wrote with toISO don't need the full dateutil parser.
+	try:
+		return datetime.fromisoformat(date.replace("Z", "+00:00"))
+	except ValueError:
+		import dateutil.parser
+		return dateutil.parser.parse(date)
+	#endtry
+#enddef
 
 def offset_year(date, offet):
 	return datetime(date.year + offet, date.month, date.day,
 		date.hour, date.minute, date.second, date.microsecond)
 #enddef
 
-def add_year(date, posted=datetime.now()):
-	if isinstance(posted, str):
+def add_year(date, posted=None):
+	import dateutil.parser
+
+	if posted is None:
+		posted = datetime.now(tz_pacific())
+	elif isinstance(posted, str):
 		posted = dateutil.parser.parse(posted)
 		posted = datetime(posted.year, posted.month, posted.day)
 	#endif
 
-	date = dateutil.parser.parse(date, tzinfos=tzinfos)
+	date = dateutil.parser.parse(date, tzinfos=tzinfos())
 	if not date.tzinfo:
-		date = date.astimezone(tz_pacific)
+		date = date.astimezone(tz_pacific())
 
 	if date < posted:
 		return offset_year(date, 1)
@@ -56,8 +87,10 @@ def add_year(date, posted=datetime.now()):
 #enddef
 
 def add_year_range(start, end):
-	start = dateutil.parser.parse(start, tzinfos=tzinfos)
-	try: end = dateutil.parser.parse(end, tzinfos=tzinfos)
+	import dateutil.parser
+
+	start = dateutil.parser.parse(start, tzinfos=tzinfos())
+	try: end = dateutil.parser.parse(end, tzinfos=tzinfos())
 	except: return start, end
 
 	if start < end:
@@ -73,13 +106,302 @@ def add_year_range(start, end):
 	#endif
 #enddef
 
+# The process umask, for files made by atomic_write. The only way to read
+# it is to set it, which would affect files other threads are creating,
+# so main() reads it once before starting any.
+umask = None
+
+def read_umask():
+	global umask
+	umask = os.umask(0)
+	os.umask(umask)
+#enddef
+
+@contextmanager
+def atomic_write(path, encoding="utf8"):
+	"""
+	Write to a temporary file next to path, then move it over path once
+	it's safely on disk. Readers (and crashes) see the old or new file,
+	never half of one.
+	"""
+	directory = os.path.dirname(os.path.abspath(path))
+	fd, tmp = tempfile.mkstemp(dir=directory, prefix=os.path.basename(path) + ".", suffix=".tmp")
+	try:
+		# mkstemp makes it 0600; keep the mode a plain open() would give.
+		try:
+			mode = os.stat(path).st_mode & 0o7777
+		except FileNotFoundError:
+			mode = 0o666 & ~(0o022 if umask is None else umask)
+		#endtry
+		os.chmod(tmp, mode)
+
+		with open(fd, "w", encoding=encoding, newline="") as f:
+			yield f
+			f.flush()
+			os.fsync(f.fileno())
+		#endwith
+		os.replace(tmp, path)
+	except BaseException:
+		try: os.unlink(tmp)
+		except FileNotFoundError: pass
+		raise
+	#endtry
+
+	# Make the rename itself durable.
+	if hasattr(os, "O_DIRECTORY"):
+		dirfd = os.open(directory, os.O_DIRECTORY)
+		try: os.fsync(dirfd)
+		finally: os.close(dirfd)
+	#endif
+#enddef
+
+def append_durably(path, write, encoding="utf8"):
+	with open(path, "a", encoding=encoding, newline="") as f:
+		write(f)
+		f.flush()
+		os.fsync(f.fileno())
+	#endwith
+#enddef
+
 def toISO(date: datetime, tz="Z"):
-	return date.astimezone(dateutil.tz.UTC).isoformat().replace("+00:00", tz)
+	return date.astimezone(timezone.utc).isoformat().replace("+00:00", tz)
+
+class TokenBucket:
+	def __init__(self, rate, burst):
+		self.rate = rate
+		self.burst = burst
+		self.tokens = burst
+		# Tokens are refilled from here; in the future while backing off.
+		self.updated = monotonic()
+		self.lock = threading.Lock()
+		self.changed = threading.Condition(self.lock)
+		self.requests = 0
+		self.waited = 0.0
+	#enddef
+
+	def refill(self, now):
+		if now > self.updated:
+			self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+			self.updated = now
+		#endif
+	#enddef
+
+	def acquire(self):
+		""" Take a token, sleeping until there is one. Returns seconds waited. """
+		start = monotonic()
+		with self.lock:
+			while True:
+				now = monotonic()
+				self.refill(now)
+				if now >= self.updated and self.tokens >= 1:
+					self.tokens -= 1
+					break
+				#endif
+
+				# Wake up when a token should be ready, or sooner if we're
+				# told to back off; either way, check again.
+				self.changed.wait(max(0, self.updated - now) + max(0, 1 - self.tokens) / self.rate)
+			#endwhile
+
+			waited = monotonic() - start
+			self.requests += 1
+			self.waited += waited
+		#endwith
+		return waited
+	#enddef
+
+	def defer(self, seconds):
+		""" Hold everyone off, including those already waiting, for the given number of seconds. """
+		with self.lock:
+			now = monotonic()
+			self.refill(now)
+			self.updated = max(self.updated, now + seconds)
+			# Let one request through when the time's up, then go by rate.
+			self.tokens = 1
+			self.changed.notify_all()
+		#endwith
+	#enddef
+#endclass
+
+class RateLimiter:
+	"""
+	Per-host token buckets, shared by everything making requests.
+	limits is a dict of host: (requests per second, burst).
+	"""
+	DEFAULT_LIMIT = (2, 5)
+
+	def __init__(self, limits=None):
+		self.limits = limits or {}
+		self.buckets = {}
+		self.lock = threading.Lock()
+	#enddef
+
+	def bucket(self, host):
+		with self.lock:
+			if host not in self.buckets:
+				self.buckets[host] = TokenBucket(*self.limits.get(host, self.DEFAULT_LIMIT))
+			#endif
+			return self.buckets[host]
+		#endwith
+	#enddef
+
+	def acquire(self, host):
+		return self.bucket(host).acquire()
+	#enddef
+
+	def defer(self, host, seconds):
+		self.bucket(host).defer(seconds)
+	#enddef
+
+	def stats(self):
+		""" Returns a dict of host: (requests made, total seconds spent queued). """
+		with self.lock:
+			buckets = list(self.buckets.items())
+		#endwith
+		return {host: (bucket.requests, bucket.waited) for host, bucket in buckets}
+	#enddef
+#endclass
+
+RATE_LIMITS = {
+	"g.nexonstatic.com": (5, 10),
+	"mabinogi.nexon.net": (2, 5),
+	"wiki.mabinogiworld.com": (1, 3),
+}
+MAX_RETRIES = 5
+BACKOFF = 2
+# mwclient also retries on maxlag and 5xx (and connection errors), on top
+# of the session's own MAX_RETRIES, so keep its count low. Worst case a
+# wiki call is tried (MAX_RETRIES + 1) * (WIKI_MAX_RETRIES + 1) times.
+WIKI_MAX_RETRIES = 2
+
+limiter = RateLimiter(RATE_LIMITS)
+
+# (wiki host, path): mwclient.Site, shared by every feed posting there.
+sites = {}
+sites_lock = threading.Lock()
+
+# (wiki host, path, title): (expiry, resolved title or None if missing)
+page_cache = {}
+page_cache_lock = threading.Lock()
+PAGE_CACHE_TTL = 3600
+
+def retry_after(value):
+	if not value:
+		return None
+	#endif
+
+	try:
+		return max(0, float(value))
+	except ValueError:
+		pass
+	#endtry
+
+	# Not imported at the top; email.utils is slow to load.
+	from email.utils import parsedate_to_datetime
+	try:
+		return max(0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+	except (TypeError, ValueError):
+		return None
+	#endtry
+#enddef
+
+@lru_cache(maxsize=None)
+def rate_limited_session():
+	"""
+	Returns a requests.Session class which waits on the shared limiter
+	before every request and backs off on 429, 503, and MediaWiki maxlag.
+	"""
+	import requests
+
+	class RateLimitedSession(requests.Session):
+		def request(self, method, url, *args, **kwargs):
+			host = urlsplit(url).hostname
+			for attempt in range(MAX_RETRIES + 1):
+				limiter.acquire(host)
+				res = super().request(method, url, *args, **kwargs)
+
+				# MediaWiki reports maxlag as a 200 with these headers.
+				if res.status_code not in (429, 503) and "X-Database-Lag" not in res.headers:
+					return res
+				elif attempt == MAX_RETRIES:
+					# Out of retries; let the caller deal with it.
+					return res
+				#endif
+
+				delay = retry_after(res.headers.get("Retry-After"))
+				if delay is None:
+					delay = BACKOFF * 2 ** attempt
+				#endif
+				logger.warning(f"{host} asked us to back off ({res.status_code}), waiting {delay:.0f}s")
+				limiter.defer(host, delay)
+				# Give the connection back to the pool, even if streaming.
+				res.close()
+			#endfor
+		#enddef
+	#endclass
+
+	return RateLimitedSession
+#enddef
 
-def get(url):
-	return requests.get(url, headers={"X-MB-API-KEY": config.X_MB_API_KEY})
+@lru_cache(maxsize=None)
+def http():
+	return rate_limited_session()()
+#enddef
+
+def get(url, **kwargs):
+	import config
+	return http().get(url, headers={"X-MB-API-KEY": config.X_MB_API_KEY}, **kwargs)
+
+JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+def iter_json_array(chunks):
+	"""
+	Yield the items of a JSON array from an iterable of text chunks as
+	each one arrives, without holding the whole document.
+	"""
+	decoder = json.JSONDecoder()
+	buf = ""
+	started = False
+	for chunk in chunks:
+		buf += chunk
+		pos = 0
+		while True:
+			pos = JSON_WHITESPACE.match(buf, pos).end()
+			if pos == len(buf):
+				break
+			elif not started:
+				if buf[pos] != "[":
+					raise ValueError("Expected a JSON array")
+				#endif
+				started = True
+				pos += 1
+			elif buf[pos] == ",":
+				pos += 1
+			elif buf[pos] == "]":
+				return
+			else:
+				try:
+					item, end = decoder.raw_decode(buf, pos)
+				except json.JSONDecodeError:
+					# Wait for the rest of this item.
+					break
+				#endtry
+				if end == len(buf):
+					# It may continue in the next chunk, eg. a split number.
+					break
+				#endif
+				yield item
+				pos = end
+			#endif
+		#endwhile
+		# Drop what's been consumed, once per chunk.
+		buf = buf[pos:]
+	#endfor
+	raise ValueError("Truncated JSON array")
+#enddef
 
 def previous_sibling(elem):
+	from bs4 import element as bs4_element
 	p = elem.previous_sibling
 	while isinstance(p, bs4_element.NavigableString):
 		p = p.previous_sibling
@@ -88,6 +410,7 @@ def previous_sibling(elem):
 #enddef
 
 def next_sibling(elem):
+	from bs4 import element as bs4_element
 	p = elem.next_sibling
 	while isinstance(p, bs4_element.NavigableString):
 		p = p.next_sibling
@@ -105,10 +428,24 @@ def ordinal(num):
 #enddef
 
 
+class StagesFailed(Exception):
+	def __init__(self, errors):
+		self.errors = errors
+		super().__init__("; ".join(
+			f"{label}: {type(error).__name__}: {error}"
+			for label, error in errors.items()
+		))
+	#enddef
+#endclass
+
+
 class NexonNews:
+	# Settings which can be overridden per feed. See load_feeds.
+	NAME = "nexon"
 	URL_ALL = "https://g.nexonstatic.com/mabinogi/cms/news"
 	URL_ALL_ARTICLE ="https://g.nexonstatic.com/mabinogi/cms/news/{}"
 	URL_SHOP_ITEM = "https://mabinogi.nexon.net/api/shop/itemdetail/cash/{}"
+	URL_ARTICLE_PAGE = "https://mabinogi.nexon.net/news/{}"
 	URL_WIKI_BASE = "wiki.mabinogiworld.com"
 	URL_WIKI_PATH = "/"
 	URL_WIKI_NEWS = "Wiki_Home/WikiUpdates"
@@ -127,7 +464,28 @@ class NexonNews:
 	BAD_IN_WIKI_LINK = re.compile(r'\[.*?\]|[\[\]\|]')
 	ITEM_COUNT = re.compile(r'\s*\(\d+\)$')
 
+	# API limit for non-bots.
+	TITLES_PER_QUERY = 50
+
 	KNOWN_FILE = "known.csv"
+	ARCHIVE_FILE = "known_archive.csv"
+	ARCHIVE_IDS_FILE = "known_archive.ids"
+	NEWS_DIR = "news"
+	SHOP_DIR = "shop"
+
+	# Per-feed paths, with the suffix to derive them from a feed's known
+	# file when only that is overridden.
+	PATH_SETTINGS = {
+		"KNOWN_FILE": None,
+		"ARCHIVE_FILE": "_archive.csv",
+		"ARCHIVE_IDS_FILE": "_archive.ids",
+		"NEWS_DIR": "_news",
+		"SHOP_DIR": "_shop",
+	}
+
+	# Save known after fetching this many new articles.
+	CHECKPOINT_EVERY = 10
+	STREAM_CHUNK_SIZE = 64 * 1024
 
 	TYPE_ORDER = [
 		"maint",
@@ -139,22 +497,23 @@ class NexonNews:
 		"art corner",
 	]
 	# index = post index
+	# link = URL_ARTICLE_PAGE for this post
 	# name = post title
 	# posted = date of nexon's post
 	# start = starting datetime of sale/event/maint
 	# end = ending datetime of sale/event/maint
 	MESSAGES = {
 		"maint": "{{{{:Wiki Home/Maintenance (new)|isScheduled={}|isUpdate={}|startUTC={start_iso}|endUTC={end_iso}|length={}|src={index}|ended={}}}}}",
-		"event": "*The [[{}]]{} has started. For more information, see [https://mabinogi.nexon.net/news/{index} here.]",
+		"event": "*The [[{}]]{} has started. For more information, see [{link} here.]",
 		"sale": {
-			"00": "*The [[{}]]{} is now available for a limited time from ??? to ???. For more information, see [https://mabinogi.nexon.net/news/{index} here]",
-			"01": "*The [[{}]]{} is now available for a limited time from ??? to {end:%B} {end.day}<sup>{end_o}</sup>. For more information, see [https://mabinogi.nexon.net/news/{index} here.]",
-			"10": "*The [[{}]]{} is now available for a limited time from {start:%B} {start.day}<sup>{start_o}</sup> to ???. For more information, see [https://mabinogi.nexon.net/news/{index} here.]",
-			"11": "*The [[{}]]{} is now available for a limited time from {start:%B} {start.day}<sup>{start_o}</sup> to {end:%B} {end.day}<sup>{end_o}</sup>. For more information, see [https://mabinogi.nexon.net/news/{index} here.]",
+			"00": "*The [[{}]]{} is now available for a limited time from ??? to ???. For more information, see [{link} here]",
+			"01": "*The [[{}]]{} is now available for a limited time from ??? to {end:%B} {end.day}<sup>{end_o}</sup>. For more information, see [{link} here.]",
+			"10": "*The [[{}]]{} is now available for a limited time from {start:%B} {start.day}<sup>{start_o}</sup> to ???. For more information, see [{link} here.]",
+			"11": "*The [[{}]]{} is now available for a limited time from {start:%B} {start.day}<sup>{start_o}</sup> to {end:%B} {end.day}<sup>{end_o}</sup>. For more information, see [{link} here.]",
 		},
-		"update": "*The {}{} has been announced. For more information, see [https://mabinogi.nexon.net/news/{index} here.]",
-		"art corner": "*The art corner for {posted:%B} is up! Check out the featured artists [https://mabinogi.nexon.net/news/{index} here.]",
-		"unknown": "*[https://mabinogi.nexon.net/news/{index} {name_safe}] (Please add details.)",
+		"update": "*The {}{} has been announced. For more information, see [{link} here.]",
+		"art corner": "*The art corner for {posted:%B} is up! Check out the featured artists [{link} here.]",
+		"unknown": "*[{link} {name_safe}] (Please add details.)",
 	}
 
 	MAINT_TEMPLATE = (
@@ -166,7 +525,29 @@ class NexonNews:
 
 	CURRENT_TEMPLATE = re.compile(r"^\|-\n\|(.*)\n\|(.*)\n\|(.*)", re.M)
 
-	def __init__(self):
+	def __init__(self, **settings):
+		overridden = set()
+		for key, value in settings.items():
+			attr = key.upper()
+			if not (attr == "NAME" or attr.startswith("URL_") or attr in self.PATH_SETTINGS) \
+			or not hasattr(self, attr):
+				raise TypeError(f"Unknown feed setting: {key}")
+			#endif
+			setattr(self, attr, value)
+			overridden.add(attr)
+		#endfor
+
+		# A feed with its own known file keeps its other files beside it,
+		# eg. mirror.csv, mirror_archive.csv, mirror_news/ ...
+		if "KNOWN_FILE" in overridden:
+			stem = os.path.splitext(self.KNOWN_FILE)[0]
+			for attr, suffix in self.PATH_SETTINGS.items():
+				if attr not in overridden and suffix is not None:
+					setattr(self, attr, stem + suffix)
+				#endif
+			#endfor
+		#endif
+
 		# idx: name, tag, type, post date, start date, end date, when to post, *other info
 		# when to post
 		#  0 - don't post
@@ -175,49 +556,151 @@ class NexonNews:
 		#  x - posted to news, needs to be posted to current
 		#  y - posted to current
 		self.known = {}
+		# IDs of entries in the archive.
+		self.archived = set()
 		self.reload_known()
 
 		self.wiki = None
+		self.dry_run = False
+		# Parse the news list as it downloads; see iter_news_list.
+		self.streaming = False
+		# Guards self.known and self.wiki when stages run concurrently.
+		self.lock = threading.RLock()
 	#enddef
 
 	## Persistent memory ##
+	# Finished entries are moved out of KNOWN_FILE into ARCHIVE_FILE, which
+	# isn't loaded. ARCHIVE_IDS_FILE lists their IDs, so we know not to
+	# fetch them again.
+	@staticmethod
+	def parse_known_row(line):
+		try: idx, name, tag, post_type, post_date, start_date, end_date, when_post, *args = line
+		except:
+			print(line)
+			raise
+		if post_date: post_date = parse_iso(post_date)
+		if start_date: start_date = parse_iso(start_date)
+		if end_date: end_date = parse_iso(end_date)
+		return idx, (name, tag, post_type, post_date, start_date, end_date, when_post, *args)
+	#enddef
+
+	@staticmethod
+	def format_known_row(idx, data):
+		name, tag, post_type, post_date, start_date, end_date, when_post, *args = data
+		if post_date: post_date = toISO(post_date)
+		if start_date: start_date = toISO(start_date)
+		if end_date: end_date = toISO(end_date)
+		return [idx, name, tag, post_type, post_date, start_date, end_date, when_post, *args]
+	#enddef
+
 	def reload_known(self):
 		known = {}
 		try:
 			with open(self.KNOWN_FILE, encoding="utf8") as f:
-				reader = csv.reader(f)
-
-				for line in reader:
+				for line in csv.reader(f):
 					if not line: continue
-					try: idx, name, tag, post_type, post_date, start_date, end_date, when_post, *args = line
-					except:
-						print(line)
-						raise
-					if post_date: post_date = dateutil.parser.parse(post_date)
-					if start_date: start_date = dateutil.parser.parse(start_date)
-					if end_date: end_date = dateutil.parser.parse(end_date)
-					known[idx] = (name, tag, post_type, post_date, start_date, end_date, when_post, *args)
+					idx, data = self.parse_known_row(line)
+					known[idx] = data
 				#endfor
 			#endwith
 		except FileNotFoundError:
 			pass
 		#endtry
 		self.known = known
+
+		archived = set()
+		try:
+			with open(self.ARCHIVE_IDS_FILE, encoding="utf8") as f:
+				archived.update(x for x in f.read().split() if x)
+			#endwith
+		except FileNotFoundError:
+			pass
+		#endtry
+		self.archived = archived
+	#enddef
+
+	def is_known(self, idx):
+		return idx in self.known or idx in self.archived
+	#enddef
+
+	def load_archived(self, idx):
+		try:
+			with open(self.ARCHIVE_FILE, encoding="utf8") as f:
+				for line in csv.reader(f):
+					if line and line[0] == idx:
+						return self.parse_known_row(line)[1]
+					#endif
+				#endfor
+			#endwith
+		except FileNotFoundError:
+			pass
+		#endtry
+		return None
+	#enddef
+
+	@staticmethod
+	def is_finished(data, now):
+		"""
+		Whether this entry will never be posted or listed again:
+		it's not to be posted, or it's been posted and is over.
+		"""
+		name, tag, post_type, post_date, start_date, end_date, when_post, *args = data
+		if when_post == "0":
+			return True
+		elif when_post in ("x", "y"):
+			if not end_date:
+				return True
+			#endif
+			if end_date.tzinfo is None:
+				end_date = end_date.astimezone(timezone.utc)
+			#endif
+			return end_date < now
+		#endif
+		return False
 	#enddef
 
 	def save_known(self):
-		with open(self.KNOWN_FILE, "w", encoding="utf8") as f:
-			writer = csv.writer(f)
-
-			for idx, (name, tag, post_type, post_date, start_date, end_date, when_post, *args) in self.known.items():
-				if post_date: post_date = toISO(post_date)
-				if start_date: start_date = toISO(start_date)
-				if end_date: end_date = toISO(end_date)
-				writer.writerow([idx, name, tag, post_type, post_date, start_date, end_date, when_post, *args])
+		with self.lock:
+			now = datetime.now(timezone.utc)
+			finished = {
+				idx: data for idx, data in self.known.items()
+				if self.is_finished(data, now)
+			}
+
+			# Archive first; if we die partway, the entries are still known
+			# and are just skipped next time.
+			to_archive = [idx for idx in finished if idx not in self.archived]
+			if to_archive:
+				append_durably(self.ARCHIVE_FILE, lambda f: csv.writer(f).writerows(
+					self.format_known_row(idx, finished[idx]) for idx in to_archive
+				))
+				append_durably(self.ARCHIVE_IDS_FILE, lambda f: f.write(
+					"".join(f"{idx}\n" for idx in to_archive)
+				))
+				self.archived.update(to_archive)
+			#endif
+
+			for idx in finished:
+				del self.known[idx]
 			#endfor
+
+			with atomic_write(self.KNOWN_FILE) as f:
+				writer = csv.writer(f)
+
+				for idx, data in self.known.items():
+					writer.writerow(self.format_known_row(idx, data))
+				#endfor
+			#endwith
 		#endwith
 	#enddef
 
+	def checkpoint(self):
+		""" Save progress mid-run, so a crash later doesn't lose it. """
+		if not self.dry_run:
+			self.save_known()
+		#endif
+	#enddef
+
 	## Download news ##
 	def fetch_news_list(self):
 		data = get(self.URL_ALL).json()
@@ -231,7 +714,22 @@ class NexonNews:
 		return articles
 	#enddef
 
+	def iter_news_list(self):
+		""" Like fetch_news_list, but parses the list as it downloads. """
+		res = get(self.URL_ALL, stream=True)
+		res.raise_for_status()
+		decoder = codecs.getincrementaldecoder(res.encoding or "utf-8")()
+		chunks = (decoder.decode(x) for x in res.iter_content(self.STREAM_CHUNK_SIZE))
+		with res:
+			for article in iter_json_array(chunks):
+				yield str(article["Id"]), article["Title"], article["LiveDate"], article["Category"]
+			#endfor
+		#endwith
+	#enddef
+
 	def pull_dates(self, article, check, post_date):
+		from bs4 import element as bs4_element
+
 		for x in article.find_all(class_="notice"):
 			sis = None
 			for _ in range(3):
@@ -307,16 +805,24 @@ class NexonNews:
 	#enddef
 
 	def fetch_article(self, idx, force=False):
-		if not force and idx in self.known:
-			return self.known[idx]
+		if not force and self.is_known(idx):
+			return self.known.get(idx) or self.load_archived(idx)
 		#endif
 
-		article_url = self.URL_ALL_ARTICLE.format(idx)
-		article = get(article_url).json()
-		
-		with open(f"news/{idx}.json", "w") as f:
+		article = get(self.URL_ALL_ARTICLE.format(idx)).json()
+
+		os.makedirs(self.NEWS_DIR, exist_ok=True)
+		with open(os.path.join(self.NEWS_DIR, f"{idx}.json"), "w") as f:
 			json.dump(article, f, indent="\t")
 
+		return self.parse_article(idx, article)
+	#enddef
+
+	def parse_article(self, idx, article):
+		import dateutil.parser
+		from bs4 import BeautifulSoup, element as bs4_element
+
+		article_url = self.URL_ALL_ARTICLE.format(idx)
 		page = BeautifulSoup(article["Body"], "lxml")
 
 		name = article["Title"]
@@ -340,7 +846,7 @@ class NexonNews:
 					if mo:
 						maint_date = f"{mo.group(0)}, {post_date.year}"
 						try:
-							test_date = dateutil.parser.parse(f"{maint_date} 11:59:59 PST", tzinfos=tzinfos)
+							test_date = dateutil.parser.parse(f"{maint_date} 11:59:59 PST", tzinfos=tzinfos())
 						except dateutil.parser.ParserError:
 							continue
 						element = x
@@ -409,8 +915,8 @@ class NexonNews:
 						post_type = "unknown"
 						when_post = "1"
 					else:
-						start_date = dateutil.parser.parse(start, tzinfos=tzinfos)
-						end_date = dateutil.parser.parse(end, tzinfos=tzinfos)
+						start_date = dateutil.parser.parse(start, tzinfos=tzinfos())
+						end_date = dateutil.parser.parse(end, tzinfos=tzinfos())
 
 						if end_date < start_date:
 							# Overnight maints
@@ -463,7 +969,8 @@ class NexonNews:
 					title = ret["Item"]["ProductTitle"]
 					titles.add(self.ITEM_COUNT.sub("", title))
 
-					with open(f"shop/{shop_idx}.json", "w") as f:
+					os.makedirs(self.SHOP_DIR, exist_ok=True)
+					with open(os.path.join(self.SHOP_DIR, f"{shop_idx}.json"), "w") as f:
 						json.dump(ret, f)
 
 				sale_name = (
@@ -509,6 +1016,11 @@ class NexonNews:
 		except:
 			print(f"Error in article: {article_url}")
 			raise
+		finally:
+			# Everything we need has been pulled out, so free the tree now
+			# rather than whenever the collector gets to its cycles.
+			page.decompose()
+		#endtry
 
 		data = (name, tag, post_type, post_date, start_date, end_date, when_post, *args)
 		self.known[idx] = data
@@ -516,35 +1028,76 @@ class NexonNews:
 	#enddef
 
 	def update_known(self):
-		for idx, *data in self.fetch_news_list():
-			if idx not in self.known:
+		if self.streaming:
+			# Only hold on to the IDs we need, and close the list's
+			# connection before spending a while fetching articles.
+			new = [idx for idx, *data in self.iter_news_list() if not self.is_known(idx)]
+		else:
+			new = [idx for idx, *data in self.fetch_news_list() if not self.is_known(idx)]
+		#endif
+
+		for i in range(0, len(new), self.CHECKPOINT_EVERY):
+			for idx in new[i:i + self.CHECKPOINT_EVERY]:
 				self.fetch_article(idx)
-			#endif
+			#endfor
+			self.checkpoint()
 		#endfor
 	#enddef
 
 	## Deal with wiki ##
 	def reconnect(self):
+		import mwclient
+		import config
+		from requests_oauthlib import OAuth1
+
 		# Whitelist tokens.
 		tokens = {}
 		for k in ("consumer_token", "consumer_secret", "access_token", "access_secret"):
 			tokens[k] = config.tokens[k]
 		#endfor
 
+		# mwclient only sets up OAuth and its User-Agent on sessions it
+		# makes itself, so do that here for ours. It gets its own session
+		# to keep the signing off Nexon requests, but shares the limiter.
+		session = rate_limited_session()()
+		session.auth = OAuth1(tokens["consumer_token"], tokens["consumer_secret"],
+			tokens["access_token"], tokens["access_secret"])
+		session.headers["User-Agent"] = f"Newscast mwclient/{mwclient.__version__}"
+
 		# Make connection.
-		self.wiki = mwclient.Site(self.URL_WIKI_BASE, path=self.URL_WIKI_PATH,
-			**tokens)
+		with sites_lock:
+			self.wiki = mwclient.Site(self.URL_WIKI_BASE, path=self.URL_WIKI_PATH,
+				pool=session, max_retries=WIKI_MAX_RETRIES, **tokens)
+			sites[(self.URL_WIKI_BASE, self.URL_WIKI_PATH)] = self.wiki
+		#endwith
 	#enddef
 
 	def connected(self):
-		if self.wiki is None:
-			self.reconnect()
+		with self.lock:
+			if self.wiki is None:
+				with sites_lock:
+					self.wiki = sites.get((self.URL_WIKI_BASE, self.URL_WIKI_PATH))
+				#endwith
+			#endif
+			if self.wiki is None:
+				self.reconnect()
+			#endif
+			return self.wiki
+		#endwith
+	#enddef
+
+	def save_page(self, url, contents, summary):
+		if self.dry_run:
+			logger.info(f"Dry run, not saving {url}:\n{contents}")
+			return
 		#endif
-		return self.wiki
+
+		page = self.connected().pages[url]
+		page.save(contents, summary)
 	#enddef
 
 	def find_postable(self):
-		now = datetime.now(tz_pacific)
+		now = datetime.now(tz_pacific())
 		postable = defaultdict(list)
 		for idx, (name, tag, post_type, post_date, start_date, end_date, when_post, *args) in self.known.items():
 			if when_post == "1":
@@ -558,7 +1111,7 @@ class NexonNews:
 			order = self.TYPE_ORDER.index(post_type)
 			if date.tzinfo is None:
 				#print(f"bad date for {idx} '{name}': {date}")
-				date = date.astimezone(dateutil.tz.UTC)
+				date = date.astimezone(timezone.utc)
 			if now > date:
 				key = date.strftime("%Y-%m-%d")
 				postable[key].append((idx, order))
@@ -586,6 +1139,8 @@ class NexonNews:
 	#enddef
 
 	def fetch_wiki_news(self):
+		import dateutil.parser
+
 		news_page = self.connected().pages[self.URL_WIKI_NEWS]
 		text = news_page.text()
 
@@ -674,6 +1229,7 @@ class NexonNews:
 
 					kwargs = {
 						"index": idx,
+						"link": self.URL_ARTICLE_PAGE.format(idx),
 						"name": name,
 						"name_safe": self.BAD_IN_WIKI_LINK.sub("", name),
 						"posted": post_date,
@@ -710,7 +1266,7 @@ class NexonNews:
 		# Build new page contents.
 		new_page = ""
 		for date in reversed(sorted(page.keys())):
-			parsed = dateutil.parser.parse(date)
+			parsed = datetime.strptime(date, "%Y-%m-%d")
 			parsed_o = ordinal(parsed.day)
 			formatted = f"{parsed:%B} {parsed.day}<sup>{parsed_o}</sup>, {parsed:%Y}"
 			content = "\n".join(x[0] for x in page[date])
@@ -726,24 +1282,29 @@ class NexonNews:
 		contents = self.build_page(news=news)
 
 		if contents:
-			page = self.connected().pages[self.URL_WIKI_NEWS]
-			page.save(contents, "Automatically updated news. Check my work please!")
+			self.save_page(self.URL_WIKI_NEWS, contents, "Automatically updated news. Check my work please!")
 		else:
 			logger.info("Nothing to update")
 		#endif
 
-		for items in news.values():
-			for idx, _ in items:
-				data = self.known[idx]
-				self.known[idx] = data[0:6] + ("x",) + data[7:]
+		with self.lock:
+			for items in news.values():
+				for idx, _ in items:
+					data = self.known[idx]
+					self.known[idx] = data[0:6] + ("x",) + data[7:]
+				#endfor
 			#endfor
-		#endfor
+		#endwith
+		self.checkpoint()
 	#enddef
 
 	def get_upcoming(self, want_type, started=False):
-		now = datetime.now().astimezone(dateutil.tz.UTC)
+		now = datetime.now().astimezone(timezone.utc)
 		ret = []
-		for idx, (name, tag, post_type, post_date, start_date, end_date, when_post, *args) in self.known.items():
+		with self.lock:
+			known = list(self.known.items())
+		#endwith
+		for idx, (name, tag, post_type, post_date, start_date, end_date, when_post, *args) in known:
 			if post_type == want_type and when_post == "x":
 				if end_date and end_date > now and (not started or (start_date and start_date < now)):
 					ret.append((idx, end_date))
@@ -769,11 +1330,10 @@ class NexonNews:
 		#endif
 
 		contents = self.MAINT_TEMPLATE.format(
-			start=start_date.astimezone(tz_pacific),
-			end=end_date.astimezone(tz_pacific)
+			start=start_date.astimezone(tz_pacific()),
+			end=end_date.astimezone(tz_pacific())
 		)
-		page = self.connected().pages[self.URL_WIKI_MAINT]
-		page.save(contents, "Automatically updated notice. Check my work please!")
+		self.save_page(self.URL_WIKI_MAINT, contents, "Automatically updated notice. Check my work please!")
 	#enddef
 
 	def fetch_current(self, text):
@@ -787,21 +1347,95 @@ class NexonNews:
 		return current
 	#enddef
 
+	def resolve_pages(self, titles):
+		"""
+		Check which wiki pages exist, following redirects, in as few
+		queries as possible. Returns a dict of title: resolved title,
+		or None if there's no such page. Results are cached for a while.
+		"""
+		now = monotonic()
+		resolved = {}
+		with page_cache_lock:
+			for title in titles:
+				cached = page_cache.get((self.URL_WIKI_BASE, self.URL_WIKI_PATH, title))
+				if cached and cached[0] > now:
+					resolved[title] = cached[1]
+				#endif
+			#endfor
+		#endwith
+
+		wanted = list(dict.fromkeys(x for x in titles if x not in resolved))
+		for i in range(0, len(wanted), self.TITLES_PER_QUERY):
+			chunk = wanted[i:i + self.TITLES_PER_QUERY]
+			query = self.connected().api("query", titles="|".join(chunk), redirects=1)["query"]
+
+			renamed = {}
+			for x in chain(query.get("normalized", []), query.get("redirects", [])):
+				renamed[x["from"]] = x["to"]
+			#endfor
+
+			pages = query.get("pages", {})
+			if isinstance(pages, dict):
+				pages = pages.values()
+			#endif
+			exists = {
+				x["title"] for x in pages
+				if "missing" not in x and "invalid" not in x
+			}
+
+			for title in chunk:
+				target = title
+				# Normalization, then the redirect.
+				for _ in range(2):
+					target = renamed.get(target, target)
+				#endfor
+				resolved[title] = target if target in exists else None
+			#endfor
+
+			with page_cache_lock:
+				for title in chunk:
+					page_cache[(self.URL_WIKI_BASE, self.URL_WIKI_PATH, title)] = (now + PAGE_CACHE_TTL, resolved[title])
+				#endfor
+			#endwith
+		#endfor
+
+		return resolved
+	#enddef
+
 	def fold_in_current(self, current, want_type):
-		added = False
 		names = {name.lower() for start, end, name, name2, idx in current}
+		new = []
 		for idx in self.get_upcoming(want_type, True):
 			name, tag, post_type, post_date, start_date, end_date, when_post, *args = self.known[idx]
+			candidates = []
 			if post_type in ("event", "sale"):
 				name = args[0]
+				if args[1]:
+					# Fall back to eg. "Some event" if there is no "Some" page.
+					candidates.append(self.BAD_IN_WIKI_LINK.sub("", name + args[1]))
+				#endif
+			#endif
 			name = self.BAD_IN_WIKI_LINK.sub("", name)
 			if name.lower() not in names:
-				# TODO: This is naive; check if page exists
-				current.append((start_date, end_date, name, name, idx))
-				added = True
+				candidates.insert(0, name)
+				new.append((start_date, end_date, name, idx, candidates))
 			#endif
 		#endfor
-		return added
+
+		if not new:
+			return False
+		#endif
+
+		resolved = self.resolve_pages([x for *_, candidates in new for x in candidates])
+		for start_date, end_date, name, idx, candidates in new:
+			link = next((resolved[x] for x in candidates if resolved.get(x)), None)
+			if link is None:
+				logger.info(f"No wiki page for {name}, linking it anyway")
+				link = name
+			#endif
+			current.append((start_date, end_date, name, link, idx))
+		#endfor
+		return True
 	#enddef
 
 	def build_current(self, url, want_type):
@@ -839,32 +1473,220 @@ class NexonNews:
 		contents, added = self.build_current(url, want_type)
 
 		if contents:
-			page = self.connected().pages[url]
-			page.save(contents, "Automatically updated current {}s. Check my work please!".format(want_type))
+			self.save_page(url, contents, "Automatically updated current {}s. Check my work please!".format(want_type))
 		else:
 			logger.info("Nothing to update")
 			return
 		#endif
 
 		added.remove(None)
-		for idx in added:
-			data = self.known[idx]
-			self.known[idx] = data[0:6] + ("y",) + data[7:]
-		#endfor
+		with self.lock:
+			for idx in added:
+				data = self.known[idx]
+				self.known[idx] = data[0:6] + ("y",) + data[7:]
+			#endfor
+		#endwith
+		self.checkpoint()
 	#enddef
 #endclass
 
-if __name__ == '__main__':
-	nn = NexonNews()
-	nn.update_known()
+def run_concurrently(jobs):
+	"""
+	Run independent page updates at the same time.
+	jobs is a dict of label: callable taking no arguments.
+	Every job runs to completion even if others fail. Returns a dict
+	of label: exception for those that failed.
+	"""
+	errors = {}
+	with ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+		futures = {executor.submit(job): label for label, job in jobs.items()}
+		for future in as_completed(futures):
+			label = futures[future]
+			try:
+				future.result()
+			except Exception as e:
+				logger.error(f"Stage {label} failed", exc_info=e)
+				errors[label] = e
+			#endtry
+		#endfor
+	#endwith
+	return errors
+#enddef
+
+FEEDS_FILE = "feeds.json"
+
+def load_feeds(path=FEEDS_FILE):
+	"""
+	Read the feeds to run from a JSON list of objects. Each object is one
+	news feed to wiki pipeline, giving its name and overriding any of
+	NexonNews's URL_* and *_FILE/*_DIR settings (in lowercase), eg.
+		[{"name": "mirror", "url_wiki_base": "mirror.example.com",
+		  "known_file": "mirror.csv", ...}]
+	Every feed needs its own name and known file, and the archive and cache paths
+	not given are named after it. No two feeds may share any of these
+	paths. Without the default feeds file, there's just the one default
+	feed.
+	"""
+	try:
+		with open(path, encoding="utf8") as f:
+			feeds = json.load(f)
+		#endwith
+	except FileNotFoundError:
+		if path != FEEDS_FILE:
+			raise
+		#endif
+		feeds = [{}]
+	#endtry
+	return feeds
+#enddef
+
+# Stages in the order they run.
+STAGES = {
+	"known": NexonNews.update_known,
+	"news": NexonNews.update_wiki,
+	"maint": NexonNews.update_maint,
+	"events": lambda nn: nn.update_current(nn.URL_WIKI_EVENTS, "event"),
+	"sales": lambda nn: nn.update_current(nn.URL_WIKI_SALES, "sale"),
+}
+
+# Stages that each edit their own page and only read known.
+PAGE_STAGES = ("maint", "events", "sales")
+
+COMMANDS = {
+	"all": ("Run every stage (default).", tuple(STAGES)),
+	"known": ("Only fetch new articles into the known list.", ("known",)),
+	"news": ("Post news to the wiki.", ("known", "news")),
+	"maint": ("Only update the maintenance banner.", ("maint",)),
+	"events": ("Only update the current events list.", ("events",)),
+	"sales": ("Only update the current sales list.", ("sales",)),
+	"current": ("Update the maintenance banner and current lists.", ("maint", "events", "sales")),
+}
+
+def add_options(parser, after_command=False):
+	"""
+	Options can go before or after the command. Ones after it are parsed
+	by the command's own parser, which would overwrite what was given
+	before, so they're kept separate and merged by parse_args.
+	"""
+	prefix = "after_" if after_command else ""
+	default = (lambda x: argparse.SUPPRESS) if after_command else (lambda x: x)
+
+	parser.add_argument("--dry-run", action="store_true", dest=prefix + "dry_run", default=default(False),
+		help="render wiki pages without saving them or the known list")
+	parser.add_argument("--stream", action="store_true", dest=prefix + "stream", default=default(False),
+		help="parse the news list as it downloads, keeping memory use low")
+	parser.add_argument("--parallel", action="store_true", dest=prefix + "parallel", default=default(False),
+		help="update the maintenance banner and current lists concurrently")
+	parser.add_argument("--skip", action="append", dest=prefix + "skip", default=default([]), choices=STAGES,
+		help="skip a stage of the selected command (repeatable)")
+	parser.add_argument("--feeds", dest=prefix + "feeds", default=default(FEEDS_FILE), metavar="FILE",
+		help=f"JSON file listing the feeds to run (default: {FEEDS_FILE})")
+	parser.add_argument("--feed", action="append", dest=prefix + "feed", default=default([]), metavar="NAME",
+		help="only run this feed (repeatable)")
+#enddef
 
-	nn.update_wiki()
+def parse_args(argv=None):
+	parser = argparse.ArgumentParser(description="Post Mabinogi news to the wiki.")
+	add_options(parser)
 
-	# Update events, sales, and maint banner
-	nn.update_maint()
-	nn.update_current(NexonNews.URL_WIKI_EVENTS, "event")
-	nn.update_current(NexonNews.URL_WIKI_SALES, "sale")
+	command_options = argparse.ArgumentParser(add_help=False)
+	add_options(command_options, after_command=True)
 
-	nn.save_known()
+	commands = parser.add_subparsers(dest="command", metavar="command")
+	for name, (description, _) in COMMANDS.items():
+		commands.add_parser(name, help=description, parents=[command_options])
+	#endfor
+
+	args = parser.parse_args(argv)
+	if args.command is None:
+		args.command = "all"
+	#endif
+
+	for key, value in list(vars(args).items()):
+		if key.startswith("after_"):
+			delattr(args, key)
+			key = key[len("after_"):]
+			if isinstance(value, list):
+				value = getattr(args, key) + value
+			#endif
+			setattr(args, key, value)
+		#endif
+	#endfor
+	return args
+#enddef
+
+def main(argv=None):
+	args = parse_args(argv)
+	setup_logging()
+	read_umask()
+	stages = [x for x in COMMANDS[args.command][1] if x not in args.skip]
+
+	feeds = [NexonNews(**feed) for feed in load_feeds(args.feeds)]
+	names = [nn.NAME for nn in feeds]
+	duplicates = {x for x in names if names.count(x) > 1}
+	if duplicates:
+		raise ValueError(f"Feed names must be unique: {', '.join(sorted(duplicates))}")
+	#endif
+
+	owners = {}
+	for nn in feeds:
+		for attr in NexonNews.PATH_SETTINGS:
+			path = os.path.abspath(getattr(nn, attr))
+			if path in owners:
+				raise ValueError(f"Feeds {owners[path]} and {nn.NAME} both use {path}")
+			#endif
+			owners[path] = nn.NAME
+		#endfor
+	#endfor
+
+	if args.feed:
+		missing = set(args.feed) - {nn.NAME for nn in feeds}
+		if missing:
+			raise ValueError(f"No such feeds: {', '.join(sorted(missing))}")
+		#endif
+		feeds = [nn for nn in feeds if nn.NAME in args.feed]
+	#endif
+	errors = {}
+	concurrent = {}
+	for nn in feeds:
+		nn.dry_run = args.dry_run
+		nn.streaming = args.stream
+		try:
+			for stage in stages:
+				if args.parallel and stage in PAGE_STAGES:
+					concurrent[f"{nn.NAME} {stage}"] = partial(STAGES[stage], nn)
+				else:
+					STAGES[stage](nn)
+				#endif
+			#endfor
+		except Exception as e:
+			# Skip the rest of this feed, but keep going with the others.
+			logger.error(f"Stage {nn.NAME} {stage} failed", exc_info=e)
+			errors[f"{nn.NAME} {stage}"] = e
+		#endtry
+	#endfor
+
+	if concurrent:
+		errors.update(run_concurrently(concurrent))
+	#endif
+
+	# Keep whatever the successful stages did.
+	if not args.dry_run:
+		for nn in feeds:
+			nn.save_known()
+		#endfor
+	#endif
+
+	for host, (count, waited) in limiter.stats().items():
+		logger.info(f"{host}: {count} requests, {waited:.1f}s queued by rate limit")
+	#endfor
+
+	if errors:
+		raise StagesFailed(errors)
+	#endif
 	logger.info("Done updating wiki.")
+#enddef
+
+if __name__ == '__main__':
+	main()
 #endif